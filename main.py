@@ -1,14 +1,20 @@
 import argparse
+import functools
+import ijson
 import json
+import orjson
 import os
 import shutil
-import exiftool
+import subprocess
+import tempfile
 import logging
+import multiprocessing
 import html
 import pathlib
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from operator import attrgetter
+from typing import Iterable, Iterator, Optional
 from rich.console import Console
 from rich.table import Table
 from rich.progress import Progress
@@ -25,6 +31,28 @@ CONTENT_TYPE_KEYS = [
     "ig_recently_deleted_media",
 ]
 
+# Exports larger than this are streamed instead of loaded into memory at once
+STREAMING_THRESHOLD_BYTES = 100 * 1024 * 1024
+
+# Files handed to each exiftool run in the worker pool
+EXIFTOOL_CHUNK_SIZE = 100
+
+# Rows shown at each end of the preview table for large archives
+PREVIEW_ROWS = 25
+
+# Instagram's exif_data keys and the EXIF tags they're written to
+# (GPS is written separately, only when both coordinates are present)
+EXIF_KEY_MAP = (
+    ("iso", "ISO"),
+    ("lens_make", "LensMake"),
+    ("lens_model", "LensModel"),
+    ("scene_type", "SceneType"),
+    ("aperture", "ApertureValue"),
+    ("shutter_speed", "ShutterSpeedValue"),
+    ("focal_length", "FocalLength"),
+    ("metering_mode", "MeteringMode"),
+)
+
 FORMAT = "%(message)s"
 if VERBOSE:
     logging.basicConfig(
@@ -34,30 +62,45 @@ if VERBOSE:
 
 @dataclass
 class ImageFile:
+    # Declared by hand since dataclass(slots=True) needs Python 3.10
+    __slots__ = ("content_type", "path", "title", "created_at", "media_metadata")
+
     content_type: str
     path: str
     title: Optional[str]
     created_at: datetime
-    exif_data: dict
+    media_metadata: dict
+
+    @property
+    def exif_data(self) -> dict:
+        # Only looked up when the tags are written
+        return self.media_metadata.get("photo_metadata", {}).get("exif_data", {})
 
 
 def unix_timestamp_to_datetime(unix_timestamp):
     try:
-        timestamp = datetime.fromtimestamp(unix_timestamp)
-        formatted_datetime = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        return formatted_datetime
+        t = datetime.fromtimestamp(unix_timestamp)
+        return f"{t.year:04d}-{t.month:02d}-{t.day:02d} {t.hour:02d}:{t.minute:02d}:{t.second:02d}"
     except OSError:
         return "Invalid timestamp"
 
 
-def to_exif_datetime(datetime: datetime) -> str:
-    return datetime.strftime("%Y:%m:%d %H:%M:%S")
+def to_exif_datetime(d: datetime) -> str:
+    # Formatting the fields directly skips strftime's format string parsing
+    return f"{d.year:04d}:{d.month:02d}:{d.day:02d} {d.hour:02d}:{d.minute:02d}:{d.second:02d}"
 
 
-def get_exif_data_for_entry(entry: dict) -> dict:
-    return (
-        entry.get("media_metadata", {}).get("photo_metadata", {}).get("exif_data", {})
-    )
+@functools.lru_cache(maxsize=4096)
+def fix_mojibake(text: Optional[str]) -> Optional[str]:
+    # Instagram exports UTF-8 text as if it were latin-1
+    if not text:
+        return None
+    return text.encode("latin-1", "replace").decode("utf-8", "replace")
+
+
+def get_media_metadata_for_entry(entry: dict) -> dict:
+    # Only this part of the entry is kept, the rest can be freed once parsed
+    return entry.get("media_metadata", {})
 
 
 def get_timestamp_for_entry(entry: dict) -> datetime:
@@ -65,66 +108,107 @@ def get_timestamp_for_entry(entry: dict) -> datetime:
     return datetime.fromtimestamp(timestamp) if timestamp else datetime.now()
 
 
-def get_path_for_entry(entry: dict, archive_path: str) -> str:
+def get_path_for_entry(entry: dict, base_path: pathlib.Path) -> Optional[str]:
     # sometimes the archive is a... URL?!
-    if "uri" not in entry or not entry["uri"] or entry["uri"] == "" or "https://" in entry["uri"]:
+    uri = entry.get("uri")
+    if not uri or uri.startswith(("http://", "https://")):
         return None
-    base_path = pathlib.Path(archive_path)
-    return str(base_path / entry["uri"]).split("?")[0]
+    return str(base_path / uri).split("?", 1)[0]
 
 
-def get_metadata_for_content_types(
-    parsed_json: dict, base_archive_path: str
+def get_metadata_for_entries(
+    entries: Iterable[tuple[str, dict]], base_archive_path: str
 ) -> list[ImageFile]:
     metadata = []
-    for content_type in CONTENT_TYPE_KEYS:
-        if not content_type in parsed_json:
-            continue
-        for entry in parsed_json[content_type]:
-            parent_entry_title = entry.get("title", None)
-            if "media" in entry:
-                # This is a multi-picture post
-                # Grab the title from the parent
-                for media in entry["media"]:
-                    title = media.get("title", None)
-                    title = (
-                        title.encode("latin-1").decode("utf-8")
-                        if title and title != ""
-                        else parent_entry_title
-                    )
-                    path = get_path_for_entry(media, base_archive_path)
-                    file = ImageFile(
-                        content_type,
-                        path,
-                        title,
-                        get_timestamp_for_entry(media),
-                        get_exif_data_for_entry(media),
-                    )
-                    if file.path and file.path != "":
-                        metadata.append(file)
-            else:
-                path = get_path_for_entry(entry, base_archive_path)
+    base_path = pathlib.Path(base_archive_path)
+    for content_type, entry in entries:
+        parent_entry_title = fix_mojibake(entry.get("title", None))
+        if "media" in entry:
+            # This is a multi-picture post
+            # Grab the title from the parent
+            for media in entry["media"]:
+                title = fix_mojibake(media.get("title", None)) or parent_entry_title
+                path = get_path_for_entry(media, base_path)
                 file = ImageFile(
                     content_type,
                     path,
-                    parent_entry_title.encode("latin-1").decode("utf-8")
-                    if parent_entry_title
-                    else None,
-                    get_timestamp_for_entry(entry),
-                    get_exif_data_for_entry(entry),
+                    title,
+                    get_timestamp_for_entry(media),
+                    get_media_metadata_for_entry(media),
                 )
                 if file.path and file.path != "":
-                  metadata.append(file)
+                    metadata.append(file)
+        else:
+            path = get_path_for_entry(entry, base_path)
+            file = ImageFile(
+                content_type,
+                path,
+                parent_entry_title,
+                get_timestamp_for_entry(entry),
+                get_media_metadata_for_entry(entry),
+            )
+            if file.path and file.path != "":
+              metadata.append(file)
     return metadata
 
 
+def get_metadata_for_content_types(
+    parsed_json: dict, base_archive_path: str
+) -> list[ImageFile]:
+    entries = (
+        (content_type, entry)
+        for content_type in CONTENT_TYPE_KEYS
+        if content_type in parsed_json
+        for entry in parsed_json[content_type]
+    )
+    return get_metadata_for_entries(entries, base_archive_path)
+
+
+def stream_entries_for_content_types(file) -> Iterator[tuple[str, dict]]:
+    # Build one entry at a time from the parser events, so only the current
+    # entry is ever held in memory
+    builder = None
+    for prefix, event, value in ijson.parse(file, use_float=True):
+        if builder is None:
+            content_type, _, rest = prefix.partition(".")
+            if (
+                event == "start_map"
+                and rest == "item"
+                and content_type in CONTENT_TYPE_KEYS
+            ):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            continue
+        builder.event(event, value)
+        if event == "end_map" and prefix == f"{content_type}.item":
+            yield content_type, builder.value
+            builder = None
+
+
+def stream_metadata_for_content_types(
+    json_file: str, base_archive_path: str
+) -> list[ImageFile]:
+    with open(json_file, "rb") as file:
+        return get_metadata_for_entries(
+            stream_entries_for_content_types(file), base_archive_path
+        )
+
+
 def display_operation_preview(image_files: list[ImageFile]) -> None:
     table = Table(title="Files to process")
     table.add_column("Path", justify="right", style="cyan", no_wrap=True)
     table.add_column("Title", style="magenta")
     table.add_column("Timestamp", justify="right", style="green")
-    image_files.sort(key=lambda x: x.created_at)
-    for item in image_files:
+    image_files.sort(key=attrgetter("created_at"))
+    rows = image_files
+    if len(image_files) > PREVIEW_ROWS * 2:
+        # Only show both ends of large archives, None marks the gap
+        rows = image_files[:PREVIEW_ROWS] + [None] + image_files[-PREVIEW_ROWS:]
+    for item in rows:
+        if item is None:
+            hidden = len(image_files) - PREVIEW_ROWS * 2
+            table.add_row("…", f"{hidden} more files", "…")
+            continue
         # Get the first two directories in the path
         uri = "/".join(item.path.split("/")[:2])
         # Trim the title if it's too long
@@ -137,36 +221,122 @@ def display_operation_preview(image_files: list[ImageFile]) -> None:
     console.print(table)
 
 
-def get_exif_tags(file: ImageFile) -> dict:
-    tags = {
-        "AllDates": to_exif_datetime(file.created_at),
-    }
-    if "latitude" in file.exif_data and "longitude" in file.exif_data:
-        tags["GPSLatitude"] = file.exif_data["latitude"]
-        tags["GPSLongitude"] = file.exif_data["longitude"]
-    if "iso" in file.exif_data:
-        tags["ISO"] = file.exif_data["iso"]
-    if "lens_make" in file.exif_data:
-        tags["LensMake"] = file.exif_data["make"]
-    if "lens_model" in file.exif_data:
-        tags["LensModel"] = file.exif_data["model"]
-    if "scene_type" in file.exif_data:
-        tags["SceneType"] = file.exif_data["scene_type"]
-    if "aperture" in file.exif_data:
-        tags["ApertureValue"] = file.exif_data["aperture"]
-    if "shutter_speed" in file.exif_data:
-        tags["ShutterSpeedValue"] = file.exif_data["shutter_speed"]
-    if "focal_length" in file.exif_data:
-        tags["FocalLength"] = file.exif_data["focal_length"]
-    if "metering_mode" in file.exif_data:
-        tags["MeteringMode"] = file.exif_data["metering_mode"]
-    if file.title and file.title != "":
-        # tags["iptc:Caption-Abstract"] = f'"{html.escape(file.title)}"'
-        tags["iptc:Keywords"] = "Instagram"
-        # tags["iptc:ObjectName"] = f'"{html.escape(file.title)}"'
-        tags["iptc:OriginatingProgram"] = "Instagram"
-        tags["iptc:codedcharacterset"] = "utf8"
-    return tags
+def write_exif_args(file: ImageFile, argfile) -> None:
+    created_at = to_exif_datetime(file.created_at)
+    argfile.write(f"-AllDates={created_at}\n")
+    # exiftool sets the filesystem timestamps after writing the file
+    argfile.write(f"-FileModifyDate={created_at}\n")
+    argfile.write(f"-FileCreateDate={created_at}\n")
+    exif_data = file.exif_data
+    if "latitude" in exif_data and "longitude" in exif_data:
+        argfile.write(f"-GPSLatitude={exif_data['latitude']}\n")
+        argfile.write(f"-GPSLongitude={exif_data['longitude']}\n")
+    for instagram_key, exif_key in EXIF_KEY_MAP:
+        if instagram_key in exif_data:
+            argfile.write(f"-{exif_key}={exif_data[instagram_key]}\n")
+    if file.title:
+        # argfile.write(f'-iptc:Caption-Abstract="{html.escape(file.title)}"\n')
+        argfile.write("-iptc:Keywords=Instagram\n")
+        # argfile.write(f'-iptc:ObjectName="{html.escape(file.title)}"\n')
+        argfile.write("-iptc:OriginatingProgram=Instagram\n")
+        argfile.write("-iptc:codedcharacterset=utf8\n")
+
+
+def write_exiftool_argfile(jobs: list[tuple[pathlib.Path, ImageFile]], argfile) -> None:
+    # One tag group per file, separated by -execute (see exiftool's -@ docs)
+    for index, (result_path, file) in enumerate(jobs):
+        if index > 0:
+            argfile.write("-execute\n")
+        write_exif_args(file, argfile)
+        argfile.write(f"{result_path}\n")
+
+
+def run_exiftool(
+    exiftool_executable: str, jobs: list[tuple[pathlib.Path, ImageFile]]
+) -> subprocess.CompletedProcess:
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".args", encoding="utf-8", delete=False
+    ) as argfile:
+        write_exiftool_argfile(jobs, argfile)
+    try:
+        return subprocess.run(
+            [
+                exiftool_executable,
+                "-@",
+                argfile.name,
+                "-common_args",
+                "-overwrite_original",
+                "-q",
+            ],
+            capture_output=True,
+            text=True,
+        )
+    finally:
+        os.remove(argfile.name)
+
+
+def chunk_list(items: list, size: int) -> list[list]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def get_exiftool_errors(
+    result: subprocess.CompletedProcess, jobs: list[tuple[pathlib.Path, ImageFile]]
+) -> tuple[list[tuple[str, str]], list[str]]:
+    # exiftool reports failures as "Error: <message> - <file>", anything
+    # without a file applies to the whole chunk
+    source_paths = {str(result_path): file.path for result_path, file in jobs}
+    file_errors = []
+    chunk_errors = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("Error:"):
+            continue
+        message, separator, path = line[len("Error:") :].strip().rpartition(" - ")
+        if separator:
+            file_errors.append((source_paths.get(path, path), message))
+        else:
+            chunk_errors.append(path)
+    if result.returncode != 0 and not file_errors and not chunk_errors:
+        chunk_errors.append(
+            result.stderr.strip() or f"exited with status {result.returncode}"
+        )
+    return file_errors, chunk_errors
+
+
+def process_chunk(
+    exiftool_executable: str, jobs: list[tuple[pathlib.Path, ImageFile]]
+) -> tuple[int, list[tuple[str, str]], list[str]]:
+    try:
+        result = run_exiftool(exiftool_executable, jobs)
+    except Exception as error:
+        # Keep the other chunks going, this one is reported at the end
+        return len(jobs), [], [f"couldn't process {len(jobs)} files: {error}"]
+    file_errors, chunk_errors = get_exiftool_errors(result, jobs)
+    return len(jobs), file_errors, chunk_errors
+
+
+def filter_missing_files(
+    image_files: list[ImageFile],
+) -> tuple[list[ImageFile], list[ImageFile]]:
+    # One scandir per source directory instead of a stat per file
+    files_by_dir = {}
+    for file in image_files:
+        directory, name = os.path.split(file.path)
+        files_by_dir.setdefault(directory, set()).add(name)
+    existing = set()
+    for directory in files_by_dir:
+        try:
+            with os.scandir(directory) as entries:
+                existing.update(
+                    entry.path
+                    for entry in entries
+                    if entry.name in files_by_dir[directory] and entry.is_file()
+                )
+        except OSError:
+            # Missing, not a directory or unreadable: its files count as missing
+            continue
+    found = [file for file in image_files if file.path in existing]
+    missing = [file for file in image_files if file.path not in existing]
+    return found, missing
 
 
 def process_files(image_files: list[ImageFile], archive_path: str) -> None:
@@ -174,32 +344,60 @@ def process_files(image_files: list[ImageFile], archive_path: str) -> None:
     if exiftool_executable is None:
         console.print("Error: exiftool not found in PATH.")
         exit(1)
-    with exiftool.ExifToolHelper(logger=logging.getLogger("rich")) as et:
-        with Progress() as progress:
-            task = progress.add_task("Processing files...", total=len(image_files))
-            for file in image_files:
-                # Set the output path, get the original extension using pathlib.
-                filename = pathlib.Path(file.path).stem
-                extension = pathlib.Path(file.path).suffix
-                username = os.path.basename(archive_path)
-                result_path = (
-                    pathlib.Path(pathlib.Path.cwd())
-                    / f"result/{username}/{file.content_type}/{filename}{extension}"
-                )
-                # Create result path
-                os.makedirs(os.path.dirname(result_path), exist_ok=True)
-                shutil.copy(file.path, result_path)
-                try:       
-                  et.set_tags(
-                      [result_path], get_exif_tags(file), params=["-overwrite_original"]
-                  )
-                except:
-                  progress.log(f"[bold red]Exiftool quit while processing {file.path}.[/]")
-                os.utime(
-                    result_path,
-                    (file.created_at.timestamp(), file.created_at.timestamp()),
-                )
+    image_files, missing_files = filter_missing_files(image_files)
+    if missing_files:
+        console.print(
+            f"[bold yellow]Skipping {len(missing_files)} files missing from the archive.[/]"
+        )
+    jobs = []
+    result_paths = set()
+    duplicate_files = 0
+    created_dirs = set()
+    username = pathlib.PurePath(archive_path).name
+    result_root = pathlib.Path.cwd() / "result" / username
+    with Progress() as progress:
+        task = progress.add_task("Copying files...", total=len(image_files))
+        for file in image_files:
+            # Set the output path, keeping the original filename and extension.
+            result_path = result_root / file.content_type / pathlib.Path(file.path).name
+            # Two exiftool workers must never rewrite the same output file
+            if result_path in result_paths:
+                duplicate_files += 1
                 progress.advance(task)
+                continue
+            result_paths.add(result_path)
+            # Create result path, once per content type
+            if result_path.parent not in created_dirs:
+                result_path.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(result_path.parent)
+            shutil.copyfile(file.path, result_path)
+            jobs.append((result_path, file))
+            progress.advance(task)
+    if duplicate_files:
+        console.print(
+            f"[bold yellow]Skipped {duplicate_files} files with the same name as an earlier file.[/]"
+        )
+    # Workers run their own exiftool over small slices, so progress stays smooth
+    processes = os.cpu_count() or 1
+    chunks = chunk_list(jobs, EXIFTOOL_CHUNK_SIZE)
+    file_errors = []
+    chunk_errors = []
+    with Progress() as progress:
+        task = progress.add_task("Writing EXIF tags...", total=len(jobs))
+        with multiprocessing.Pool(processes=processes) as pool:
+            for processed, new_file_errors, new_chunk_errors in pool.imap_unordered(
+                functools.partial(process_chunk, exiftool_executable), chunks
+            ):
+                file_errors.extend(new_file_errors)
+                chunk_errors.extend(new_chunk_errors)
+                progress.advance(task, processed)
+    # Report failures once at the end instead of logging inside the loop
+    if file_errors:
+        console.print(f"[bold red]Exiftool failed on {len(file_errors)} files.[/]")
+        for path, message in file_errors[:20]:
+            console.print(f"{path}: {message}")
+    for message in chunk_errors:
+        console.print(f"[bold red]Exiftool batch failed:[/] {message}")
 
 
 def process_json_file(json_file):
@@ -210,17 +408,22 @@ def process_json_file(json_file):
         should_exit = console.input("Is this correct? [Y/n]") == "n"
         if should_exit:
             exit(0)
-        with open(json_file, "r", encoding="utf-8") as file:
-            data = json.load(file)
+        if os.path.getsize(json_file) > STREAMING_THRESHOLD_BYTES:
+            files = stream_metadata_for_content_types(json_file, base_archive_path)
+        else:
+            with open(json_file, "rb") as file:
+                data = orjson.loads(file.read())
             files = get_metadata_for_content_types(data, base_archive_path)
-            display_operation_preview(files)
-            should_exit = input("Continue? [Y/n]") == "n"
-            if should_exit:
-                exit(0)
-            process_files(files, base_archive_path)
+        display_operation_preview(files)
+        should_exit = input("Continue? [Y/n]") == "n"
+        if should_exit:
+            exit(0)
+        # Group files by output directory so they're written together
+        files.sort(key=attrgetter("content_type", "created_at"))
+        process_files(files, base_archive_path)
     except FileNotFoundError:
         print("Error: JSON file not found.")
-    except json.JSONDecodeError:
+    except (orjson.JSONDecodeError, json.JSONDecodeError, ijson.JSONError):
         print("Error: Invalid JSON format.")
 
 